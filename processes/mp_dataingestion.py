@@ -27,6 +27,8 @@ import os
 import datetime
 import configparser
 import geopandas as gpd
+import fiona
+from fiona.session import AWSSession
 import logging
 import boto3
 from botocore.exceptions import ClientError
@@ -36,8 +38,11 @@ import geoalchemy2
 
 logger = logging.getLogger("PYWPS")
 
-# read config
-if os.name == "nt":
+# read config, MARINEPROJECTS_CONFIGURATION overrides the default locations
+if os.environ.get("MARINEPROJECTS_CONFIGURATION"):
+    fc = os.environ["MARINEPROJECTS_CONFIGURATION"]
+    logger.info(f"path to configuration {fc}")
+elif os.name == "nt":
     fc = r"C:\develop\marineprojects_wps\configuration.txt"
 else:
     fc = os.path.join(os.path.dirname(os.path.realpath(__file__)), "configuration.txt")
@@ -54,12 +59,25 @@ cf.read(fc)
 s3id = cf.get("s3", "aws_access_key_id")
 s3key = cf.get("s3", "aws_secret_access_key")
 s3region = cf.get("s3", "region_name")
+# optional, endpoint of an S3 compatible store (e.g. a local MinIO), empty means AWS
+s3endpoint = cf.get("s3", "endpoint_url", fallback="")
+# optional, read mode of the geopackage, download (default) or direct (via GDAL /vsis3/)
+s3readmode = cf.get("s3", "read_mode", fallback="").strip().lower() or "download"
+if s3readmode not in ("download", "direct"):
+    logger.error(f"unknown read_mode {s3readmode} in {fc}, use download or direct")
+    raise ValueError(f"unknown read_mode {s3readmode} in {fc}, use download or direct")
+# optional, size in MB of the block cache used in direct read mode
+s3cachesize = int(cf.get("s3", "cache_size_mb", fallback="").strip() or 64)
+if s3cachesize <= 0:
+    logger.error(f"cache_size_mb {s3cachesize} in {fc} should be larger than 0")
+    raise ValueError(f"cache_size_mb {s3cachesize} in {fc} should be larger than 0")
 
 s3 = boto3.resource(
     "s3",
     aws_access_key_id=f"{s3id}",
     aws_secret_access_key=f"{s3key}",
     region_name=f"{s3region}",
+    endpoint_url=s3endpoint or None,
 )
 
 
@@ -118,6 +136,82 @@ def s3fileprocessing(bucket_name, key, localfile):
         else:
             raise
 
+
+def s3gdaloptions():
+    """Returns the GDAL configuration options to read an object from S3 with /vsis3/
+       Only the byte ranges (SQLite pages) requested by GDAL are fetched and kept
+       in a block cache, so nothing is written to local disk.
+
+    Returns:
+        options (dict): GDAL configuration options
+    """
+    options = {
+        "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+        "VSI_CACHE": "TRUE",
+        "VSI_CACHE_SIZE": str(s3cachesize * 1024 * 1024),
+        "CPL_VSIL_CURL_CACHE_SIZE": str(s3cachesize * 1024 * 1024),
+    }
+    if s3endpoint:
+        # S3 compatible store, GDAL expects host[:port] and path style addressing
+        scheme, _, host = s3endpoint.partition("://")
+        if not host:
+            scheme, host = "https", scheme
+        options["AWS_S3_ENDPOINT"] = host.rstrip("/")
+        options["AWS_HTTPS"] = "YES" if scheme == "https" else "NO"
+        options["AWS_VIRTUAL_HOSTING"] = "FALSE"
+    return options
+
+
+def s3gdalsession():
+    """Returns the session with the S3 credentials for GDAL
+       fiona does not accept credentials as configuration options, these are passed
+       with an AWSSession. Empty values are passed as None, so GDAL falls back to its
+       defaults (us-east-1 region, instance credentials) instead of signing requests
+       with an empty scope.
+
+    Returns:
+        session (AWSSession): fiona session with the S3 credentials
+    """
+    return AWSSession(
+        aws_access_key_id=s3id or None,
+        aws_secret_access_key=s3key or None,
+        region_name=s3region or None,
+    )
+
+
+def s3readgeopackage(bucket_name, key, localfile, readmode=None):
+    """Reads the geopackage from defined bucket into a GeoPandas dataframe
+       With readmode download the file is stored locally first (see s3fileprocessing),
+       with readmode direct the file is read from S3 with range requests via /vsis3/
+
+    Args:
+        bucket_name (string): S3 bucketname
+        key (string):         Key (full path and filename)
+        localfile (string):   targetfile to store (only used with readmode download)
+        readmode (string):    download or direct, defaults to read_mode in configuration
+
+    Returns:
+        gdf (GeoPandas dataframe): geodataframe with the contents of the geopackage
+        source (string):           local file or /vsis3/ path the data is read from
+    """
+    readmode = readmode or s3readmode
+    if readmode == "direct":
+        source = f"/vsis3/{bucket_name}/{key}"
+        logger.info(f"data read directly from {source}")
+        # fiona is forced, fiona.Env does not pass the GDAL config options to the
+        # pyogrio engine (default since geopandas 1.0)
+        with fiona.Env(session=s3gdalsession(), **s3gdaloptions()):
+            gdf = gpd.read_file(source, engine="fiona")
+    elif readmode == "download":
+        source = localfile
+        s3fileprocessing(bucket_name, key, localfile)
+        logger.info(f"data downloaded to {localfile}")
+        gdf = gpd.read_file(localfile)
+    else:
+        raise ValueError(f"unknown read_mode {readmode}, use download or direct")
+    return gdf, source
+
+
 def loaddata2pg_production(gdf, schema):
     """This function creates a table based on the contents of the Geopandas Dataframe
        The function creates a copy of the data based on current datatime
@@ -315,15 +409,8 @@ def mainhandler(bucket_name, key, test):
         else:
             localfile = "/opt/pywps/geopackage/new.gpkg"
 
-        # get file from s3
-        s3fileprocessing(bucket_name, key, localfile)
-        msg = f"data downloaded to {localfile}"
-        logger.info(msg)
-        
-
-        # read file with geopandas
-        # gdf = gpd.read_file(localfile, layer="krm_actuele_dataset")
-        gdf = gpd.read_file(localfile)
+        # get file from s3 and read file with geopandas
+        gdf, source = s3readgeopackage(bucket_name, key, localfile)
 
         # derive some stats
         nrrecords = len(gdf)
@@ -331,7 +418,7 @@ def mainhandler(bucket_name, key, test):
         gdfcrs = gdf.crs
 
         # load data in pg
-        string = f"File ({localfile}) is valid geopackage with {nrrecords} of records in {nrcolums} columns, with csr {str(gdfcrs)}"
+        string = f"File ({source}) is valid geopackage with {nrrecords} of records in {nrcolums} columns, with csr {str(gdfcrs)}"
         logger.info(string)
         logger.info(f'the value of test is {test}')
         if test == 'True':
@@ -351,7 +438,8 @@ def mainhandler(bucket_name, key, test):
             logger.info('value of test',test)
 
     except:
-        string = "downloading file failed"
+        logger.exception("Full traceback:")
+        string = f"ingestion failed (read_mode {s3readmode}), see log"
     finally:
         logger.info(string)
         return string
@@ -360,7 +448,7 @@ def mainhandler(bucket_name, key, test):
 def mainhandler_dev(bucket_name, key):
     """Dev ingestion handler.
 
-    Downloads the provided GeoPackage from S3, reads it with GeoPandas and loads it into
+    Downloads (or reads directly, see read_mode) the provided GeoPackage from S3, reads it with GeoPandas and loads it into
     the dev schema using the production-style loader (daily backup + append).
 
     Args:
@@ -380,14 +468,8 @@ def mainhandler_dev(bucket_name, key):
         else:
             localfile = "/opt/pywps/geopackage/new.gpkg"
 
-        # get file from s3
-        s3fileprocessing(bucket_name, key, localfile)
-        msg = f"data downloaded to {localfile}"
-        logger.info(msg)
-
-        # read file with geopandas
-        # gdf = gpd.read_file(localfile, layer="krm_actuele_dataset")
-        gdf = gpd.read_file(localfile)
+        # get file from s3 and read file with geopandas
+        gdf, source = s3readgeopackage(bucket_name, key, localfile)
 
         # derive some stats
         nrrecords = len(gdf)
@@ -395,7 +477,7 @@ def mainhandler_dev(bucket_name, key):
         gdfcrs = gdf.crs
 
         # load data in pg
-        string = f"File ({localfile}) is valid geopackage with {nrrecords} of records in {nrcolums} columns, with csr {str(gdfcrs)}"
+        string = f"File ({source}) is valid geopackage with {nrrecords} of records in {nrcolums} columns, with csr {str(gdfcrs)}"
         logger.info(string)
 
         succeeded = loaddata2pg_test(gdf, schema)
@@ -403,7 +485,8 @@ def mainhandler_dev(bucket_name, key):
             string = string + " loaded in dev schema, and data service refreshed"
 
     except:
-        string = "downloading file failed"
+        logger.exception("Full traceback:")
+        string = f"ingestion failed (read_mode {s3readmode}), see log"
     finally:
         logger.info(string)
         return string
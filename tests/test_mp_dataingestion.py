@@ -0,0 +1,202 @@
+"""Tests for reading the geopackage from S3, against a local S3 stand-in (moto server)"""
+
+import importlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+from unittest import mock
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+
+BUCKET = "krm-validatie-data-test"
+KEY = "geopackage/output.gpkg"
+
+
+def writeconfiguration(fc, endpoint, read_mode="download", cache_size_mb="64"):
+    fc.write_text(
+        "[s3]\n"
+        "aws_access_key_id = testing\n"
+        "aws_secret_access_key = testing\n"
+        "region_name = \n"
+        f"endpoint_url = {endpoint}\n"
+        f"read_mode = {read_mode}\n"
+        f"cache_size_mb = {cache_size_mb}\n"
+    )
+    return fc
+
+
+def loadmodule(fc):
+    # the module reads the configuration on import, (re)load it with the given one
+    with mock.patch.dict(os.environ, {"MARINEPROJECTS_CONFIGURATION": str(fc)}):
+        from processes import mp_dataingestion
+
+        return importlib.reload(mp_dataingestion)
+
+
+@pytest.fixture(scope="module")
+def recording(tmp_path_factory):
+    return tmp_path_factory.mktemp("moto") / "recording.jsonl"
+
+
+@pytest.fixture(scope="module")
+def s3server(recording):
+    # moto server in a separate process, GDAL holds the GIL while reading so an
+    # in-process (threaded) server would never answer the range requests
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, "-m", "moto.server", "-H", "127.0.0.1", "-p", str(port)],
+        env={
+            **os.environ,
+            "MOTO_ENABLE_RECORDING": "True",
+            "MOTO_RECORDER_FILEPATH": str(recording),
+        },
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    endpoint = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            with urllib.request.urlopen(f"{endpoint}/moto-api/"):
+                break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        server.terminate()
+        pytest.fail("moto server did not start")
+    yield endpoint
+    server.terminate()
+    server.wait()
+
+
+@pytest.fixture(scope="module")
+def configuration(s3server, tmp_path_factory):
+    fc = tmp_path_factory.mktemp("config") / "configuration.txt"
+    return writeconfiguration(fc, s3server)
+
+
+@pytest.fixture(scope="module")
+def mp(configuration):
+    return loadmodule(configuration)
+
+
+@pytest.fixture(scope="module")
+def gpkg(mp, tmp_path_factory):
+    gdf = gpd.GeoDataFrame(
+        {"naam": [f"locatie {i}" for i in range(100)], "waarde": range(100)},
+        geometry=[Point(3.0 + i / 100, 52.0 + i / 100) for i in range(100)],
+        crs="EPSG:4258",
+    )
+    localfile = tmp_path_factory.mktemp("upload") / "upload.gpkg"
+    gdf.to_file(localfile, layer="krm_actuele_dataset", driver="GPKG")
+    mp.s3.create_bucket(Bucket=BUCKET)
+    mp.s3.Bucket(BUCKET).upload_file(str(localfile), KEY)
+    return gdf
+
+
+def test_blank_optional_options(configuration, s3server, tmp_path):
+    fc = writeconfiguration(
+        tmp_path / "configuration.txt", s3server, read_mode="", cache_size_mb=""
+    )
+    try:
+        module = loadmodule(fc)
+        assert module.s3readmode == "download"
+        assert module.s3cachesize == 64
+    finally:
+        loadmodule(configuration)
+
+
+def test_invalid_options(configuration, s3server, tmp_path):
+    try:
+        fc = writeconfiguration(tmp_path / "readmode.txt", s3server, read_mode="s3")
+        with pytest.raises(ValueError):
+            loadmodule(fc)
+        fc = writeconfiguration(tmp_path / "cache.txt", s3server, cache_size_mb="0")
+        with pytest.raises(ValueError):
+            loadmodule(fc)
+    finally:
+        loadmodule(configuration)
+
+
+def test_s3gdaloptions_endpoint(mp, s3server):
+    options = mp.s3gdaloptions()
+    assert options["AWS_S3_ENDPOINT"] == s3server.split("://")[1]
+    assert options["AWS_HTTPS"] == "NO"
+    assert options["AWS_VIRTUAL_HOSTING"] == "FALSE"
+
+
+def test_s3gdalsession_empty_region(mp):
+    # empty region is not passed, GDAL falls back to its default
+    options = mp.s3gdalsession().get_credential_options()
+    assert options["AWS_ACCESS_KEY_ID"] == "testing"
+    assert "AWS_REGION" not in options
+
+
+def test_direct_equals_download(mp, gpkg, tmp_path):
+    localfile = tmp_path / "new.gpkg"
+    gdfdownload, source = mp.s3readgeopackage(
+        BUCKET, KEY, str(localfile), readmode="download"
+    )
+    assert source == str(localfile)
+    assert localfile.exists()
+
+    gdfdirect, source = mp.s3readgeopackage(
+        BUCKET, KEY, str(tmp_path / "direct.gpkg"), readmode="direct"
+    )
+    assert source == f"/vsis3/{BUCKET}/{KEY}"
+    assert len(gdfdirect) == len(gdfdownload) == len(gpkg)
+    assert gdfdirect.crs == gdfdownload.crs == gpkg.crs
+    assert gdfdirect.equals(gdfdownload)
+
+
+def test_direct_writes_no_localfile(mp, gpkg, tmp_path):
+    localfile = tmp_path / "new.gpkg"
+    mp.s3readgeopackage(BUCKET, KEY, str(localfile), readmode="direct")
+    assert not localfile.exists()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_unknown_readmode(mp, gpkg, tmp_path):
+    with pytest.raises(ValueError):
+        mp.s3readgeopackage(BUCKET, KEY, str(tmp_path / "new.gpkg"), readmode="s3")
+
+
+def test_direct_uses_range_requests(mp, gpkg, s3server, recording, tmp_path):
+    # separate key, so nothing is served from the GDAL cache of the earlier tests
+    key = "geopackage/range.gpkg"
+    localfile = tmp_path / "upload.gpkg"
+    gpkg.to_file(localfile, layer="krm_actuele_dataset", driver="GPKG")
+    mp.s3.Bucket(BUCKET).upload_file(str(localfile), key)
+
+    request = urllib.request.Request(
+        f"{s3server}/moto-api/recorder/reset-recording", method="POST"
+    )
+    with urllib.request.urlopen(request):
+        pass
+    mp.s3readgeopackage(BUCKET, key, str(tmp_path / "new.gpkg"), readmode="direct")
+
+    entries = [json.loads(line) for line in recording.read_text().splitlines()]
+    gets = [
+        entry
+        for entry in entries
+        if entry["method"] == "GET"
+        and urllib.parse.urlparse(entry["url"]).path == f"/{BUCKET}/{key}"
+    ]
+    assert gets
+    # every read of the object is a range request for a part of it, and with the
+    # block cache no part is fetched twice
+    size = localfile.stat().st_size
+    fetched = 0
+    for entry in gets:
+        first, last = entry["headers"]["Range"].removeprefix("bytes=").split("-")
+        assert int(last) - int(first) + 1 < size
+        fetched += int(last) - int(first) + 1
+    assert fetched <= size